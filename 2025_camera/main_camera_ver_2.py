@@ -4,14 +4,27 @@ import struct
 import time
 import numpy as np
 import threading
+from turbojpeg import TurboJPEG, TJPF_BGR, TJSAMP_420, TJFLAG_FASTDCT
 # import json # 未使用のためコメントアウト
 
+# 毎フレーム使う書式は事前にコンパイルしておく
+_TS_STRUCT = struct.Struct('>d')  # タイムスタンプ (8バイト、double)
+_LEN_STRUCT = struct.Struct('>L') # データ長 (4バイト)
+_TS_PREFIX = b't'
+_CAM_PREFIX = b'c'
+
+# エンコード設定は固定 (640x480 BGR)。4:2:0 サブサンプリングと高速DCTで1フレームあたりの処理量を減らす
+_JPEG_SUBSAMPLE = TJSAMP_420
+_JPEG_FLAGS = TJFLAG_FASTDCT
+
 class CameraClient:
     def __init__(self, server_ip, server_port=9999):
         self.server_ip = server_ip
         self.server_port = server_port
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1) # 小さなヘッダがNagleで待たされないようにする
         self.loop_running = True
+        self.__loop_thread_capture = None
         self.__loop_thread_send = None
         self.__loop_thread_recv = None
         
@@ -20,6 +33,15 @@ class CameraClient:
         
         self.__recv_data_lock = threading.Lock() # 受信データ保護用ロック
         self.__requested_camera_num = 1 # サーバーから要求されたカメラ番号を保持
+
+        # キャプチャスレッドから送信スレッドへ最新フレームのみを受け渡す (古いフレームは捨てる)
+        self.__latest_cond = threading.Condition()
+        self.__latest_camera_data = None
+
+        # 送信ヘッダは毎フレーム生成せず、事前確保したバッファの値だけを書き換える
+        # すべてのメッセージは 種別 (1バイト) + データ長 (4バイト) の固定ヘッダで始まる
+        self.__timestamp_header = bytearray(_TS_PREFIX + _LEN_STRUCT.pack(_TS_STRUCT.size) + bytes(_TS_STRUCT.size)) # 't' + 8 + タイムスタンプ (double)
+        self.__camera_header = bytearray(_CAM_PREFIX + bytes(_LEN_STRUCT.size)) # 'c' (1バイト) + データ長 (4バイト)
         
         # カメラ初期化はconnect前に必要なので、ここで実施
         self.cameras = Camera.initialize_cameras() 
@@ -28,8 +50,10 @@ class CameraClient:
         try:
             self.socket.connect((self.server_ip, self.server_port))
             print(f"[INFO] サーバ ({self.server_ip}:{self.server_port}) に接続しました。")
+            self.__loop_thread_capture = threading.Thread(target=self.capture_loop, daemon=True)
             self.__loop_thread_send = threading.Thread(target=self.send_loop, daemon=True) # daemon=Trueを追加
             self.__loop_thread_recv = threading.Thread(target=self.receive_loop, daemon=True) # daemon=Trueを追加
+            self.__loop_thread_capture.start()
             self.__loop_thread_send.start()
             self.__loop_thread_recv.start()
 
@@ -47,6 +71,10 @@ class CameraClient:
             print("[INFO] 停止要求を受け取りました。")
         finally:
             self.loop_running = False
+            with self.__latest_cond:
+                self.__latest_cond.notify_all() # 待機中の送信スレッドを起こす
+            if self.__loop_thread_capture and self.__loop_thread_capture.is_alive():
+                self.__loop_thread_capture.join(timeout=1)
             if self.__loop_thread_send and self.__loop_thread_send.is_alive():
                 self.__loop_thread_send.join(timeout=1)
             if self.__loop_thread_recv and self.__loop_thread_recv.is_alive():
@@ -57,7 +85,8 @@ class CameraClient:
                     cam_obj._Camera__camera.release()
             print("[INFO] クライアント終了。")
 
-    def send_loop(self):
+    def capture_loop(self):
+        # キャプチャ＆エンコードを送信とは別スレッドで行い、カメラ待ちと送信待ちを重ねる
         try:
             while self.loop_running:
                 try:
@@ -72,22 +101,45 @@ class CameraClient:
                             target_camera_data = cam_obj.capture_and_encode()
                             break
                     
-                    if target_camera_data:
-                        # まずタイムスタンプを送信
-                        self.__timestamp_send()
-                        # 次にカメラデータを送信
-                        self.socket.sendall(target_camera_data)
-                        # print(f"[DEBUG] カメラ{current_request_num}のデータを送信しました。")
+                    if target_camera_data is not None:
+                        # 最新フレームを差し替える (未送信の古いフレームは破棄される)
+                        with self.__latest_cond:
+                            self.__latest_camera_data = target_camera_data
+                            self.__latest_cond.notify()
                     else:
                         # 要求されたカメラが見つからない場合は、デフォルトのカメラ1を試す
                         # print(f"[WARN] カメラ{current_request_num}のデータが見つかりません。デフォルトのカメラ1を試します。")
                         with self.__recv_data_lock:
                             self.__requested_camera_num = 1 # デフォルトに戻す
                         time.sleep(0.1) # 無限ループにならないように待機
-                        print()
                         continue
-                    
-                    time.sleep(0.01) # 送信レートの調整
+
+                except Exception as e:
+                    print(f"[ERROR] キャプチャループ中にエラー発生: {e}")
+                    self.loop_running = False
+                    break
+        finally:
+            with self.__latest_cond:
+                self.__latest_cond.notify_all() # 送信スレッドが待機したままにならないようにする
+
+    def send_loop(self):
+        try:
+            while self.loop_running:
+                try:
+                    # キャプチャスレッドから最新フレームを受け取る (送信レートはカメラのフレームレートで決まる)
+                    with self.__latest_cond:
+                        self.__latest_cond.wait_for(
+                            lambda: self.__latest_camera_data is not None or not self.loop_running,
+                            timeout=1.0)
+                        target_camera_data = self.__latest_camera_data
+                        self.__latest_camera_data = None
+
+                    if target_camera_data is None:
+                        continue
+
+                    # タイムスタンプとカメラデータをまとめて送信
+                    self.__frame_send(target_camera_data)
+                    # print(f"[DEBUG] カメラのデータを送信しました。")
 
                 except (ConnectionResetError, BrokenPipeError):
                     print("[ERROR] サーバとの接続が切断されました。送信ループを終了します。")
@@ -148,33 +200,62 @@ class CameraClient:
     # def recv_data_get(self):
     #     return int(struct.unpack('>c',self.__recv_data)[0]) # struct.unpack('>c', self.__recv_data) は1バイトなのでint()でキャストできる
 
-    def __timestamp_send(self):
-        timestamp = time.time()
-        # 't' (1バイト) + タイムスタンプ (8バイト、double)
-        self.socket.sendall(struct.pack(">c", b't') + struct.pack('>d', timestamp))
+    def __frame_send(self, frame_data):
+        # 't' (1バイト) + データ長 8 (4バイト) + タイムスタンプ (8バイト、double)
+        _TS_STRUCT.pack_into(self.__timestamp_header, 1 + _LEN_STRUCT.size, time.time())
+        # 'c' (1バイト) + データ長 (4バイト) + データ本体
+        _LEN_STRUCT.pack_into(self.__camera_header, 1, len(frame_data))
+        # 3つのバッファを連結せずに1回の sendmsg で書き込む
+        self.__sendmsg_all([self.__timestamp_header, self.__camera_header, frame_data])
+
+    def __sendmsg_all(self, buffers):
+        if not hasattr(self.socket, 'sendmsg'):
+            # Windows には sendmsg がないため、連結して1回の sendall で送信する
+            self.socket.sendall(b''.join(buffers))
+            return
+        buffers = [memoryview(buf) for buf in buffers]
+        while buffers:
+            sent = self.socket.sendmsg(buffers)
+            # 部分送信された場合は送信済みの分を取り除いて残りを送る
+            while buffers and sent >= buffers[0].nbytes:
+                sent -= buffers[0].nbytes
+                buffers.pop(0)
+            if sent:
+                buffers[0] = buffers[0][sent:]
 
 class Camera: # クラス名を'camera'から'Camera'に変更 (PEP8準拠)
-    def __init__(self, jpeg_quality, cap, camera_num):
+    def __init__(self, jpeg_quality, cap, camera_num, passthrough=False):
         self.__camera = cap
-        self.__jpeg_quality = jpeg_quality
+        self.__jpeg_quality = jpeg_quality # MJPEGをそのまま転送できない場合のみ使用
         self.camera_num = camera_num
+        self.__passthrough = passthrough # カメラが出力するMJPEGを再エンコードせずに転送する
         self.__camera_data = None # キャプチャ＆エンコードされたデータ
+        self.__frame = np.empty((480, 640, 3), dtype=np.uint8) # キャプチャ用バッファ (毎フレーム再利用)
+        self.__tj = TurboJPEG() # libjpeg-turbo を直接呼び出すエンコーダ (cv2.imencode より高速)
 
     @staticmethod # initialize_camerasをクラスメソッドに変更
     def initialize_cameras(jpeg_quality=40): # デフォルト品質を60に設定
         cameras = []
         camera_num = 1
         for i in range(10):
-            cap = cv2.VideoCapture(i, cv2.CAP_MSMF)
+            cap = cv2.VideoCapture(i, cv2.CAP_DSHOW)
             if cap.isOpened():
                 print(f"[INFO] カメラ {i} を初期化しました。")
+                # MJPGを要求する (解像度より先に設定しないと反映されないドライバがある)
+                mjpg = cv2.VideoWriter_fourcc(*'MJPG')
+                cap.set(cv2.CAP_PROP_FOURCC, mjpg)
                 cap.set(cv2.CAP_PROP_FRAME_WIDTH, 640)  # 例: 幅を640ピクセルに設定
                 cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 480) # 例: 高さを480ピクセルに設定
 
                 # ここでFPSを30に設定します
                 cap.set(cv2.CAP_PROP_FPS, 30) 
+
+                # MJPGが受け付けられた場合はデコードを無効にし、圧縮データをそのまま受け取る
+                passthrough = int(cap.get(cv2.CAP_PROP_FOURCC)) == mjpg and cap.set(cv2.CAP_PROP_CONVERT_RGB, 0)
+                if not passthrough:
+                    print(f"[INFO] カメラ {i} はMJPGに対応していないため、JPEGエンコードを行います。")
                 
-                cameras.append(Camera(jpeg_quality=jpeg_quality, cap=cap, camera_num=camera_num))
+                cameras.append(Camera(jpeg_quality=jpeg_quality, cap=cap, camera_num=camera_num, passthrough=passthrough))
                 camera_num += 1
             else:
                 # print(f"[WARN] カメラ {i} は利用できません。") # ログが多すぎる場合があるのでコメントアウト
@@ -187,28 +268,48 @@ class Camera: # クラス名を'camera'から'Camera'に変更 (PEP8準拠)
     #     pass
 
     def __capture_camera(self, cap):
-        ret, frame = cap.read()
-        if not ret:
+        if not cap.grab():
             # print("[WARN] フレーム取得に失敗しました。") # ログが多すぎる場合があるのでコメントアウト
             return None
+        # MJPEGの生データ (1次元のバイト列) を受け取る。送信スレッドへ渡すため毎回新しい配列にする
+        ret, frame = cap.retrieve()
+        return frame if ret else None
+
+    def __capture_frame(self, cap):
+        if not cap.grab():
+            return None
+        # 事前確保したバッファに直接読み込む (サイズが異なる場合はOpenCVが再確保するので差し替える)
+        ret, frame = cap.retrieve(self.__frame)
+        if not ret:
+            return None
+        self.__frame = frame
         return frame
 
     def __encode_data(self, frame):
         if frame is None:
             return None
-        encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), self.__jpeg_quality]
-        result, encimg = cv2.imencode('.jpg', frame, encode_param)
-        if not result:
+        # BGRフレームをそのまま libjpeg-turbo に渡す (色変換パスなし)
+        try:
+            return self.__tj.encode(frame, quality=self.__jpeg_quality, pixel_format=TJPF_BGR,
+                                    jpeg_subsample=_JPEG_SUBSAMPLE, flags=_JPEG_FLAGS)
+        except OSError:
             # print("[WARN] JPEGエンコードに失敗しました。") # ログが多すぎる場合があるのでコメントアウト
             return None
-        return encimg.tobytes()
     
     def capture_and_encode(self):
-        # 'c' (1バイト) + データ長 (4バイト) + データ本体
-        frame_data = self.__encode_data(self.__capture_camera(self.__camera))
-        if frame_data:
-            # struct.pack(">c", ord('c')) を struct.pack(">c", b'c') に修正
-            self.__camera_data = struct.pack(">c", b'c') + struct.pack('>L', len(frame_data)) + frame_data
+        # JPEGデータ本体のみを返す (ヘッダは送信側で付与する)
+        if self.__passthrough:
+            frame = self.__capture_camera(self.__camera)
+            if frame is not None and frame.ndim != 3:
+                # MJPEGはすでにJPEGなので再エンコードせずにそのまま転送する
+                frame_data = frame.reshape(-1)
+            else:
+                # ドライバがBGRにデコードして返した場合はエンコードする
+                frame_data = self.__encode_data(frame)
+        else:
+            frame_data = self.__encode_data(self.__capture_frame(self.__camera))
+        if frame_data is not None and len(frame_data):
+            self.__camera_data = frame_data
             return self.__camera_data
         return None
 
@@ -3,107 +3,315 @@ import socket
 import struct
 import numpy as np
 import time
-from collections import deque
+import sys
 import threading
+import asyncio
+import multiprocessing
+from multiprocessing import shared_memory
+from turbojpeg import TurboJPEG, TJPF_BGR
+try:
+    import uvloop # 利用可能であれば高速なイベントループを使う (Windowsでは未対応)
+except ImportError:
+    uvloop = None
+
+_REQUEST_STRUCT = struct.Struct('>B') # クライアントへ送るカメラ番号 (1バイト)
+_TS_STRUCT = struct.Struct('>d') # クライアントから届くタイムスタンプ (8バイト、double)
+
+# デコード用共有メモリの配置
+FRAME_SHAPE = (480, 640, 3) # クライアント側のキャプチャ設定 (640x480 BGR) と一致させる
+FRAME_NBYTES = int(np.prod(FRAME_SHAPE))
+JPEG_SLOT_SIZE = 1 << 20 # 受け渡しできるJPEGの最大サイズ
+_SLOT_HEADER = struct.Struct('=QL') # フレーム番号 (8バイト) + データ長 (4バイト)
+_FRAME_HEADER = struct.Struct('=QL') # フレーム番号 (8バイト) + 公開中のスロット番号 (4バイト)
+
+def wait_next_period(next_deadline, period_ns):
+    # 締め切り時刻基準で次の周期まで待つ (固定のsleepと違い、処理時間分のずれを蓄積させない)
+    # 間に合わなかった場合は基準を現在時刻にリセットする。次回の基準となる時刻を返す
+    next_deadline += period_ns
+    slack = next_deadline - time.monotonic_ns()
+    if slack > 0:
+        time.sleep(slack / 1e9)
+        return next_deadline
+    return time.monotonic_ns()
+
+def frame_slots(frame_shm):
+    # デコード結果用の共有メモリを2面のフレームとして参照する (書き込み中の面は表示側から読まれない)
+    return [np.ndarray(FRAME_SHAPE, dtype=np.uint8, buffer=frame_shm.buf, offset=_FRAME_HEADER.size + i * FRAME_NBYTES)
+            for i in range(2)]
+
+def open_gpu_decoder():
+    # CUDA が使える場合は nvJPEG (torchvision) でデコードする関数を返す。使えなければ None
+    # torch の import は重いため、デコードプロセス内で必要になったときにだけ行う
+    try:
+        import torch
+        from torchvision.io import decode_jpeg, ImageReadMode
+    except ImportError:
+        return None
+    if not torch.cuda.is_available():
+        return None
+
+    def decode(jpeg, dst):
+        data = torch.frombuffer(jpeg, dtype=torch.uint8)
+        image = decode_jpeg(data, mode=ImageReadMode.RGB, device='cuda') # (3, H, W) の RGB (GPU上)
+        # GPU上で BGR / (H, W, 3) に並べ替え、共有メモリの面へ直接ダウンロードする
+        torch.from_numpy(dst).copy_(image.flip(0).permute(1, 2, 0))
+
+    return decode
+
+def decode_worker(jpeg_shm_name, frame_shm_name, jpeg_lock, frame_lock, jpeg_ready, stop, use_gpu_decode=False):
+    # 別プロセスで動くデコーダ本体。GILを共有しないため表示や通信と並列に動ける
+    tj = TurboJPEG()
+    # GPUデコードは指定された場合のみ使う (プロセスごとに torch の import と CUDA コンテキスト生成が発生するため)
+    gpu_decode = open_gpu_decoder() if use_gpu_decode else None
+    if gpu_decode is not None:
+        print("[INFO] nvJPEG (CUDA) でデコードします。")
+    elif use_gpu_decode:
+        print("[INFO] CUDA が利用できないため、CPU (libjpeg-turbo) でデコードします。")
+    jpeg_shm = shared_memory.SharedMemory(name=jpeg_shm_name)
+    frame_shm = shared_memory.SharedMemory(name=frame_shm_name)
+    jpeg_buf = bytearray(JPEG_SLOT_SIZE) # 共有メモリからの取り出し用 (ロック保持時間を短くするため)
+    slots = frame_slots(frame_shm)
+    write_index = 1 # 表示側に公開していない方の面
+    last_seq = 0
+    try:
+        while not stop.is_set():
+            if not jpeg_ready.wait(0.5):
+                continue
+            jpeg_ready.clear()
+            with jpeg_lock:
+                seq, length = _SLOT_HEADER.unpack_from(jpeg_shm.buf, 0)
+                jpeg_buf[:length] = jpeg_shm.buf[_SLOT_HEADER.size:_SLOT_HEADER.size + length]
+            if seq == last_seq:
+                continue
+            last_seq = seq
+
+            jpeg = memoryview(jpeg_buf)[:length]
+            try:
+                width, height, _, _ = tj.decode_header(jpeg)
+                if (height, width) != FRAME_SHAPE[:2]:
+                    print(f"[WARN] 想定外の画像サイズを受信しました: {width}x{height}")
+                    continue
+                # 新しい配列を確保せず、共有メモリの未公開の面へ直接デコードする
+                decoded = False
+                if gpu_decode is not None:
+                    try:
+                        gpu_decode(jpeg, slots[write_index])
+                        decoded = True
+                    except RuntimeError:
+                        # nvJPEG が受け付けないストリーム (DHTを省略したMJPEGなど) は CPU でデコードする
+                        pass
+                if not decoded:
+                    tj.decode(jpeg, pixel_format=TJPF_BGR, dst=slots[write_index])
+            except OSError:
+                print("[WARN] Received data could not be decoded to an image.")
+                continue
+            except Exception as e:
+                # 1フレームの異常でデコードプロセスごと止まらないよう、そのフレームだけ破棄して続行する
+                print(f"[ERROR] デコード中に予期せぬエラー: {e}")
+                continue
+
+            with frame_lock:
+                _FRAME_HEADER.pack_into(frame_shm.buf, 0, seq, write_index)
+            write_index ^= 1
+    finally:
+        del slots
+        jpeg_shm.close()
+        frame_shm.close()
+
+class FrameDecoder:
+    # 1クライアント分のJPEGデコードを専用プロセスで行い、結果を共有メモリで受け渡す
+    def __init__(self, use_gpu_decode=False):
+        self.__jpeg_shm = shared_memory.SharedMemory(create=True, size=_SLOT_HEADER.size + JPEG_SLOT_SIZE)
+        self.__frame_shm = shared_memory.SharedMemory(create=True, size=_FRAME_HEADER.size + 2 * FRAME_NBYTES)
+        _SLOT_HEADER.pack_into(self.__jpeg_shm.buf, 0, 0, 0)
+        _FRAME_HEADER.pack_into(self.__frame_shm.buf, 0, 0, 0)
+        self.__frame_slots = frame_slots(self.__frame_shm)
+
+        self.__jpeg_lock = multiprocessing.Lock()
+        self.__frame_lock = multiprocessing.Lock()
+        self.__jpeg_ready = multiprocessing.Event()
+        self.__stop = multiprocessing.Event()
+        self.__process = multiprocessing.Process(
+            target=decode_worker,
+            args=(self.__jpeg_shm.name, self.__frame_shm.name, self.__jpeg_lock, self.__frame_lock, self.__jpeg_ready, self.__stop,
+                  use_gpu_decode),
+            daemon=True)
+        self.__process.start()
+        self.__closed = False
+
+    # デコードプロセスが動作しているか
+    def is_alive(self):
+        return not self.__closed and self.__process.is_alive()
+
+    # 受信したJPEGをデコードプロセスに渡す（イベントループのスレッドから呼び出し）
+    # デコードプロセスが終了している場合は RuntimeError (呼び出し側でクライアントを切断する)
+    def submit(self, seq, jpeg_data):
+        if not self.is_alive():
+            raise RuntimeError("デコードプロセスが終了しています。")
+        length = len(jpeg_data)
+        if length > JPEG_SLOT_SIZE:
+            print(f"[WARN] JPEGデータが大きすぎるため破棄します: {length} bytes")
+            return
+        with self.__jpeg_lock:
+            self.__jpeg_shm.buf[_SLOT_HEADER.size:_SLOT_HEADER.size + length] = jpeg_data
+            _SLOT_HEADER.pack_into(self.__jpeg_shm.buf, 0, seq, length)
+        self.__jpeg_ready.set()
+
+    # デコード済みの最新フレームを out にコピーし、そのフレーム番号を返す（表示スレッド用）
+    # known_seq と同じフレームであればコピーを省略する。まだデコード結果がない、
+    # またはデコードプロセスが終了している場合は None (古いフレームを表示し続けないようにする)
+    def read_frame(self, out, known_seq=None):
+        if not self.is_alive():
+            return None
+        with self.__frame_lock:
+            seq, index = _FRAME_HEADER.unpack_from(self.__frame_shm.buf, 0)
+            if seq == 0:
+                return None
+            if seq != known_seq:
+                np.copyto(out, self.__frame_slots[index])
+        return seq
+
+    def close(self):
+        if self.__closed:
+            return
+        self.__closed = True
+        self.__stop.set()
+        self.__jpeg_ready.set()
+        self.__process.join(timeout=1)
+        if self.__process.is_alive():
+            self.__process.terminate()
+        del self.__frame_slots
+        for shm in (self.__jpeg_shm, self.__frame_shm):
+            shm.close()
+            shm.unlink()
 
 class CameraServer:
     # 定数をクラス変数として定義し、インスタンス生成不要にする
     DATA_TYPE_SIZE = struct.calcsize('>c')
     DATA_LEN_SIZE = struct.calcsize('>L')
     DATA_DECIMAL_SIZE = struct.calcsize('>d')
+    HEADER_SIZE = DATA_TYPE_SIZE + DATA_LEN_SIZE # 種別 (1バイト) + データ長 (4バイト)
+    MAX_UNKNOWN_DATA_SIZE = 1024 # 未知の種別のデータとして読み捨てる最大サイズ
+    DISPLAY_PERIOD_NS = 10_000_000 # 表示更新の周期 (10ms)
+    LATENCY_HISTORY_SIZE = 100 # 平均レイテンシの計算に使うサンプル数
 
-    def __init__(self, host='0.0.0.0', port=9999, timeout_sec=60):
+    def __init__(self, host='0.0.0.0', port=9999, timeout_sec=60, use_gpu_decode=False):
         self.host = host
         self.port = port
         self.timeout_sec = timeout_sec
-        self.latency_history = deque(maxlen=100)
+        self.use_gpu_decode = use_gpu_decode # True の場合、CUDA が使えれば nvJPEG でデコードする
+        # 直近のレイテンシを保持するリングバッファ。平均を毎回 sum() せずに済むよう合計も更新していく
+        self.__latency_buf = [0.0] * CameraServer.LATENCY_HISTORY_SIZE
+        self.__latency_idx = 0
+        self.__latency_count = 0
+        self.__latency_sum = 0.0
         self.active_clients = [] # 複数のクライアントを管理
-        self.lock = threading.Lock()
+        self.lock = threading.Lock() # イベントループのスレッドと表示(メイン)スレッド間の排他
         
         # 受信したカメラデータとレイテンシ情報を保持する変数
         # 各クライアントからの最新データを保持できるように辞書型に変更
-        self.__client_camera_data = {} 
+        self.__client_decoders = {} # addr -> FrameDecoder (クライアントごとのデコードプロセス)
         self.__client_latency_time = {} 
 
+        self.__frame_seq = 0 # 受信したカメラフレームの通し番号 (表示側で新着判定に使う)
+
         self.recv_data_running = True # サーバループ全体の実行フラグ
+        self.__last_connect_time = time.time() # 最後にクライアントが接続した時刻 (無接続タイムアウト用)
+
+        # クライアントとの通信はすべて1つのイベントループ (別スレッド) で処理する
+        self.__loop = uvloop.new_event_loop() if uvloop else asyncio.new_event_loop()
+        self.__stop_event = asyncio.Event()
+        self.__client_tasks = set() # 実行中の受信タスク (終了時に完了を待つため参照を保持する)
 
         # 送信するカメラ番号をバイト形式で初期化 (デフォルトはカメラ1)
-        self.__send_camera_request = struct.pack('>B', 1) 
+        self.__send_camera_request = _REQUEST_STRUCT.pack(1) 
 
         self.qr_detector = cv2.QRCodeDetector()
         self.qr_request = False
         self.qr_result = None # QRコードの表示結果
 
-    def recv_all(self, sock, size):
-        data = b''
-        while len(data) < size:
-            try:
-                packet = sock.recv(size - len(data))
-                if not packet:
+    async def recv_all(self, sock, size, addr, timeout=None):
+        # 事前確保した bytearray に recv_into で直接書き込む (data += packet による再確保とコピーをなくす)
+        buf = bytearray(size)
+        view = memoryview(buf)
+        offset = 0
+        try:
+            while offset < size:
+                if timeout is None:
+                    n = await self.__loop.sock_recv_into(sock, view[offset:])
+                else:
+                    n = await asyncio.wait_for(self.__loop.sock_recv_into(sock, view[offset:]), timeout)
+                if not n:
                     # 接続が正常に閉じられた場合
                     return None
-                data += packet
-            except socket.timeout:
-                print(f"[WARN] ソケットタイムアウト ({sock.getpeername()})")
-                return None
-            except ConnectionResetError:
-                print(f"[ERROR] クライアント ({sock.getpeername()}) が強制的に切断されました。")
-                return None
-            except Exception as e:
-                print(f"[ERROR] データ受信エラー ({sock.getpeername()}): {e}")
-                return None
-        return data
+                offset += n
+        except asyncio.TimeoutError:
+            print(f"[WARN] ソケットタイムアウト ({addr})")
+            return None
+        except ConnectionResetError:
+            print(f"[ERROR] クライアント ({addr}) が強制的に切断されました。")
+            return None
+        except Exception as e:
+            print(f"[ERROR] データ受信エラー ({addr}): {e}")
+            return None
+        return buf
     
-    def recv_data(self, sock, addr):
-        print(f"[INFO] 受信スレッド開始: {addr}")
-        sock.settimeout(self.timeout_sec)
-        
+    async def recv_data(self, sock, addr):
+        print(f"[INFO] 受信処理開始: {addr}")
+        decoder = None
         try:
+            # プロセス起動待ちでイベントループを止めないよう、別スレッドで生成する
+            decoder = await self.__loop.run_in_executor(None, FrameDecoder, self.use_gpu_decode)
+            with self.lock:
+                self.__client_decoders[addr] = decoder
+            # 現在のカメラ要求を最初に1回だけ送る (以降はキー入力のたびに全クライアントへ送信する)
+            with self.lock:
+                msg = self.__send_camera_request
+            await self.send_data(sock, msg)
+
             while self.recv_data_running:
-                # 最初にデータタイプ (1バイト) を受信
-                data_type_bytes = self.recv_all(sock, CameraServer.DATA_TYPE_SIZE)
-                if data_type_bytes is None: # 接続切断など
+                # すべてのメッセージは固定長ヘッダ (種別 1バイト + データ長 4バイト) と本体の2回の受信で読む
+                # 無通信タイムアウトはヘッダの受信でのみ監視する
+                header = await self.recv_all(sock, CameraServer.HEADER_SIZE, addr, self.timeout_sec)
+                if header is None: # 接続切断など
+                    break
+                data_type = header[0:1] # 1バイトの bytearray (struct.unpack を通さずに比較する)
+                data_length = int.from_bytes(header[CameraServer.DATA_TYPE_SIZE:], 'big')
+
+                # 本体のバッファを確保する前にデータ長を検証する (不正な長さで巨大なメモリを確保しないため)
+                # 不正な場合はストリームの区切りが信用できないので、接続を切断する
+                if data_type == b'c':
+                    length_ok = data_length <= JPEG_SLOT_SIZE
+                elif data_type == b't':
+                    length_ok = data_length == CameraServer.DATA_DECIMAL_SIZE
+                else:
+                    length_ok = data_length <= CameraServer.MAX_UNKNOWN_DATA_SIZE
+                if not length_ok:
+                    print(f"[WARN] 不正なデータ長です (種別 {data_type}, {data_length}バイト) from {addr}。接続を切断します。")
+                    break
+
+                body = await self.recv_all(sock, data_length, addr)
+                if body is None:
                     break
-                
-                data_type = struct.unpack('>c', data_type_bytes)[0]
                 
                 if data_type == b'c': # カメラデータ
-                    # データ長 (4バイト) を受信
-                    data_length_bytes = self.recv_all(sock, CameraServer.DATA_LEN_SIZE)
-                    if data_length_bytes is None:
-                        break
-                    data_length = struct.unpack('>L', data_length_bytes)[0]
-                    
-                    # カメラデータ本体を受信
-                    camera_data_bytes = self.recv_all(sock, data_length)
-                    if camera_data_bytes is None:
-                        break
-                    
-                    with self.lock:
-                        # 複数クライアント対応のため辞書に格納
-                        self.__client_camera_data[addr] = camera_data_bytes
+                    # デコードはクライアント専用のプロセスで行う
+                    self.__frame_seq += 1
+                    decoder.submit(self.__frame_seq, body)
                     
-                elif data_type == b't': # タイムスタンプデータ
-                    # タイムスタンプ (8バイト double) を受信
-                    timestamp_bytes = self.recv_all(sock, CameraServer.DATA_DECIMAL_SIZE)
-                    if timestamp_bytes is None:
-                        break
-                    
-                    client_timestamp = struct.unpack('>d', timestamp_bytes)[0]
+                elif data_type == b't': # タイムスタンプデータ (8バイト double、長さは受信前に確認済み)
+                    client_timestamp = _TS_STRUCT.unpack_from(body, 0)[0]
                     server_receive_time = time.time()
                     latency_ms = (server_receive_time - client_timestamp) * 1000
                     
                     with self.lock:
-                        self.latency_history.append(latency_ms)
+                        self.__add_latency(latency_ms)
                         # 複数クライアント対応のため辞書に格納
                         self.__client_latency_time[addr] = latency_ms
 
                 else:
+                    # データ長がわかっているので、本体を読み捨てて次のメッセージから受信を続ける
                     print(f"[WARN] 予期しないタイプのデータを受信 ({data_type}) from {addr}")
-                    # 不明なデータを受信した場合、そのデータが続く可能性があるため、
-                    # ある程度のバイト数を読み飛ばすなどして次回の受信に備えるか、
-                    # 接続を閉じるかを検討する。今回は一旦接続を閉じないでおく。
-                    pass
         
         except Exception as e:
             print(f"[ERROR] クライアント ({addr}) 受信処理中に例外: {e}")
@@ -111,68 +319,79 @@ class CameraServer:
             with self.lock:
                 if sock in self.active_clients:
                     self.active_clients.remove(sock)
-                if addr in self.__client_camera_data:
-                    del self.__client_camera_data[addr]
+                if addr in self.__client_decoders:
+                    del self.__client_decoders[addr]
                 if addr in self.__client_latency_time:
                     del self.__client_latency_time[addr]
 
             sock.close()
-            print(f"[INFO] クライアント ({addr}) 切断。受信スレッド終了。")
+            if decoder is not None:
+                # プロセス終了待ちでイベントループを止めないよう、別スレッドで後始末する
+                await self.__loop.run_in_executor(None, decoder.close)
+            print(f"[INFO] クライアント ({addr}) 切断。受信処理終了。")
             if not self.active_clients and not self.display_thread_running():
                 print("[INFO] 全クライアントが切断されました。サーバを終了します。")
                 self.recv_data_running = False # 全クライアント切断でサーバー終了
-                cv2.destroyAllWindows()
-                # ここでメインスレッドに終了シグナルを送る必要があるが、今回は recv_data_running で制御
+                # cv2.destroyAllWindows() はメインスレッドで行う
 
-    def send_data(self, sock, addr):
-        print(f"[INFO] 送信スレッド開始: {addr}")
+    async def send_data(self, sock, msg):
         try:
-            while self.recv_data_running: # サーバループ全体の実行フラグに連動
-                with self.lock:
-                    # __send_camera_requestは struct.pack('>B', cam_id) されたもの
-                    msg = self.__send_camera_request
-                
-                try:
-                    sock.sendall(msg)
-                    # print(f"[DEBUG] カメラ要求 {struct.unpack('>B', msg)[0]} を {addr} に送信")
-                except BrokenPipeError:
-                    print(f"[ERROR] クライアント ({addr}) のパイプが切断されました。")
-                    break
-                except socket.error as se:
-                    print(f"[ERROR] ソケットエラー (送信スレッド {addr}): {se}")
-                    break
-                
-                time.sleep(0.1) # 送信レートの調整
-        except Exception as e:
-            print(f"[ERROR] クライアント ({addr}) 送信処理中に例外: {e}")
-        finally:
-            # recv_data側でクライアントをactive_clientsから削除しているので、ここでは不要
-            # ただし、例外発生時に確実にクローズされるよう、sock.close()は必要に応じて配置
-            pass # 終了処理はrecv_dataで行う
+            await self.__loop.sock_sendall(sock, msg)
+            # print(f"[DEBUG] カメラ要求 {_REQUEST_STRUCT.unpack(msg)[0]} を送信")
+        except (BrokenPipeError, ConnectionResetError):
+            # 切断の後始末は recv_data で行う
+            print("[ERROR] クライアントのパイプが切断されました。")
+        except socket.error as se:
+            print(f"[ERROR] ソケットエラー (カメラ要求の送信): {se}")
+
+    async def __broadcast_camera_request(self):
+        # カメラ要求が指定されるたびに、接続中の全クライアントへまとめて送信する
+        with self.lock:
+            msg = self.__send_camera_request
+            clients = list(self.active_clients)
+        for sock in clients:
+            await self.send_data(sock, msg)
 
-    # クライアントからの最新カメラデータを取得（表示スレッド用）
-    def get_latest_camera_data(self):
+    # クライアントからのデコード済み最新フレームを out にコピーし、フレーム番号を返す（表示スレッド用）
+    def get_latest_camera_data(self, out, known_seq=None):
         with self.lock:
             # 複数クライアントが存在する場合、ここでは最初のクライアントのデータを返す
             # 必要であれば、特定のクライアントのデータを指定できるように引数を追加
-            if self.__client_camera_data:
-                # 辞書の最初の要素の値を返す
-                return next(iter(self.__client_camera_data.values())) 
+            if self.__client_decoders:
+                # 辞書の最初の要素のフレームを返す
+                return next(iter(self.__client_decoders.values())).read_frame(out, known_seq)
         return None
     
+    # レイテンシのサンプルを追加する (self.lock を保持した状態で呼び出す)
+    def __add_latency(self, latency_ms):
+        idx = self.__latency_idx
+        self.__latency_sum += latency_ms - self.__latency_buf[idx]
+        self.__latency_buf[idx] = latency_ms
+        self.__latency_idx = (idx + 1) % CameraServer.LATENCY_HISTORY_SIZE
+        if self.__latency_count < CameraServer.LATENCY_HISTORY_SIZE:
+            self.__latency_count += 1
+        if self.__latency_idx == 0:
+            # 浮動小数点の誤差が蓄積しないよう、一周ごとに合計を計算し直す
+            self.__latency_sum = sum(self.__latency_buf)
+
     # クライアントからの最新レイテンシを取得（表示スレッド用）
     def get_latest_latency_data(self):
         with self.lock:
-            if self.latency_history:
-                return sum(self.latency_history) / len(self.latency_history)
+            if self.__latency_count:
+                return self.__latency_sum / self.__latency_count
         return 0.0 # データがない場合は0を返す
     
     # クライアントに送るカメラ番号を設定（メインスレッド/表示スレッドから呼び出し）
     def set_camera_request(self, camera_num):
         if 1 <= camera_num <= 9: # 1から9までの数字に限定
+            # 1バイトの符号なし整数としてパック
+            msg = _REQUEST_STRUCT.pack(camera_num)
             with self.lock:
-                # 1バイトの符号なし整数としてパック
-                self.__send_camera_request = struct.pack('>B', camera_num) 
+                self.__send_camera_request = msg
+            # 値が同じでも送り直す (クライアント側がカメラ1に戻っている場合があり、再送で同期し直せるようにする)
+            if self.__loop.is_running():
+                # 送信はイベントループのスレッドで行う
+                asyncio.run_coroutine_threadsafe(self.__broadcast_camera_request(), self.__loop)
         else:
             print(f"[WARN] 無効なカメラ番号が設定されました: {camera_num}。無視します。")
 
@@ -183,54 +402,93 @@ class CameraServer:
                     # ここでは常にTrueを返しても問題ないが、
                     # 将来的にはDisplayクラス内にフラグを持たせ、それを参照するべき
 
-    def run(self): 
-        print(f"[INFO] サーバ起動中 ({self.host}:{self.port})") 
+    def __run_event_loop(self):
+        asyncio.set_event_loop(self.__loop)
+        try:
+            self.__loop.run_until_complete(self.__serve())
+        finally:
+            self.__loop.close()
+
+    async def __accept_loop(self, server_socket):
+        while self.recv_data_running:
+            try:
+                conn, addr = await self.__loop.sock_accept(server_socket)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"[ERROR] accept中に予期せぬエラー: {e}")
+                self.recv_data_running = False 
+                break
+            conn.setblocking(False)
+            with self.lock:
+                self.active_clients.append(conn)
+                self.__last_connect_time = time.time()
+            print(f"[INFO] 新規クライアント接続: {addr}")
+            task = asyncio.ensure_future(self.recv_data(conn, addr))
+            self.__client_tasks.add(task)
+            task.add_done_callback(self.__client_tasks.discard)
+
+    async def __serve(self):
         server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1) 
-        server_socket.bind((self.host, self.port)) 
-        server_socket.listen(5)
-        server_socket.settimeout(0.01) # タイムアウトを短くして、より頻繁にメインループが回るようにする
+        try:
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1) 
+            server_socket.bind((self.host, self.port)) 
+            server_socket.listen(5)
+            server_socket.setblocking(False)
+        except Exception as e:
+            print(f"[ERROR] サーバ起動に失敗しました: {e}")
+            server_socket.close()
+            self.recv_data_running = False
+            return
+
+        accept_task = asyncio.ensure_future(self.__accept_loop(server_socket))
+        await self.__stop_event.wait()
+        accept_task.cancel()
+        server_socket.close()
+        # 接続中のクライアントを切断して受信処理を終わらせる
+        with self.lock:
+            clients = list(self.active_clients)
+        for sock in clients:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        # 各受信タスクが後始末 (ソケットとデコードプロセスの終了) を終えるまで待つ
+        await asyncio.gather(accept_task, *self.__client_tasks, return_exceptions=True)
 
+    def run(self): 
+        print(f"[INFO] サーバ起動中 ({self.host}:{self.port})") 
         main_display = Display(server=self) 
 
-        start_time = time.time() 
+        # accept と送受信はイベントループのスレッドで行い、メインスレッドは表示に専念する
+        loop_thread = threading.Thread(target=self.__run_event_loop, daemon=True)
+        loop_thread.start()
+
         timeout_limit = 60 
 
+        frame_buf = np.empty(FRAME_SHAPE, dtype=np.uint8) # 表示用フレーム (毎回再利用)
+        frame_seq = None
+        next_deadline = time.monotonic_ns()
+
         # frame_count と display_skip_frames は削除（常に最新を表示するため）
         # frame_count = 0 
         # display_skip_frames = 1 
 
         while self.recv_data_running:
-            try:
-                conn, addr = server_socket.accept() 
-                with self.lock:
-                    self.active_clients.append(conn) 
-                print(f"[INFO] 新規クライアント接続: {addr}")
-                thread_recv = threading.Thread(target=self.recv_data, args=(conn, addr), daemon=True)
-                thread_send = threading.Thread(target=self.send_data, args=(conn, addr), daemon=True)
-                thread_recv.start() 
-                thread_send.start()
-                start_time = time.time() 
-            except socket.timeout:
-                with self.lock:
-                    if not self.active_clients:
-                        if time.time() - start_time > timeout_limit:
-                            print(f"[INFO] {timeout_limit}秒間誰も接続しなかったためサーバを終了します。")
-                            self.recv_data_running = False 
-                            break
-            except Exception as e:
-                print(f"[ERROR] accept中に予期せぬエラー: {e}")
-                self.recv_data_running = False 
-                break
+            with self.lock:
+                if not self.active_clients:
+                    if time.time() - self.__last_connect_time > timeout_limit:
+                        print(f"[INFO] {timeout_limit}秒間誰も接続しなかったためサーバを終了します。")
+                        self.recv_data_running = False 
+                        break
 
-            # ★ここから変更★
             # クライアントからのデータ表示とキーボード処理 (メインスレッド)
-            latest_camera_data = self.get_latest_camera_data()
+            frame_seq = self.get_latest_camera_data(frame_buf, frame_seq)
             avg_latency = self.get_latest_latency_data() # レイテンシも取得
 
-            # 常に最新のデータがあれば表示を試みる
-            if latest_camera_data:
-                main_display.show_window(latest_camera_data, avg_latency)
+            # 常に最新のデータがあれば表示を試みる (前回と同じフレームなら描画は省略される)
+            if frame_seq is not None:
+                main_display.show_window(frame_buf, avg_latency, frame_seq)
             else:
                 # データがない場合でもウィンドウを表示し、キー入力は受け付ける
                 # show_window内で黒画面表示とwaitKey処理を集約させるため、ここも変更
@@ -238,12 +496,18 @@ class CameraServer:
 
             # キーボード処理はDisplayクラスのメソッドに任せるが、waitKeyはDisplayクラス内の一箇所に集約
             main_display.keyboard_processing(self) 
-            # ★ここまで変更★
 
             if not self.recv_data_running: 
                 break
 
-        server_socket.close()
+            # 接続の受け付けはイベントループ側で行うため、表示は接続の有無に左右されず一定周期で更新する
+            next_deadline = wait_next_period(next_deadline, CameraServer.DISPLAY_PERIOD_NS)
+
+        self.recv_data_running = False
+        if not self.__loop.is_closed():
+            self.__loop.call_soon_threadsafe(self.__stop_event.set)
+        # デコードプロセスの終了は各受信タスクが行うので、その分も待つ
+        loop_thread.join(timeout=5)
         cv2.destroyAllWindows()
         print("[INFO] サーバを終了しました。")
 
@@ -251,6 +515,7 @@ class Display: # クラス名を'display'から'Display'に変更 (PEP8準拠)
     def __init__(self, server):
         self.__server = server # Serverインスタンスへの参照を保持
         self.__window_data = None
+        self.__last_frame_seq = None # 最後にデコードしたフレーム番号
         self.qr_request = False
         self.qr_result = None  # QRコードの表示結果
         self.qr_detector = cv2.QRCodeDetector()
@@ -259,21 +524,21 @@ class Display: # クラス名を'display'から'Display'に変更 (PEP8準拠)
     # def clean(): # 未使用かつ実装がないため削除
     #     pass
 
-    def draw_image(self):
-        if self.__window_data is not None:
-            self.__window_data = cv2.resize(self.__window_data, (640, 480)) # 適切なサイズに調整
-        else:
-            # データがない場合は黒い画面を表示
-            self.__window_data = np.zeros((480, 640, 3), dtype=np.uint8)
-
-    def read_qr(self):
-        if self.qr_request and self.__window_data is not None:
-            data, points, _ = self.qr_detector.detectAndDecode(self.__window_data)
+    def read_qr(self, frame):
+        if self.qr_request and frame is not None:
+            # 検出処理は画素数に比例するため、縦横1/2に縮小した画像で検出する
+            small = cv2.resize(frame, None, fx=0.5, fy=0.5, interpolation=cv2.INTER_AREA)
+            data, points, _ = self.qr_detector.detectAndDecode(small)
+            scale = 2.0
+            if not data:
+                # 小さいQRコードは縮小すると読めないことがあるため、原寸で再試行する
+                data, points, _ = self.qr_detector.detectAndDecode(frame)
+                scale = 1.0
             if data:
                 self.qr_result = f"QR: {data}"
                 # 検出されたQRコードの周りにポリゴンを描画
                 if points is not None:
-                    points = np.intp(points) # 整数型に変換
+                    points = np.intp(points * scale) # 原寸の座標に戻して整数型に変換
                     cv2.polylines(self.__window_data, [points], True, (0, 255, 0), 2)
             else:
                 self.qr_result = "QR not detected"
@@ -285,25 +550,26 @@ class Display: # クラス名を'display'から'Display'に変更 (PEP8準拠)
                 cv2.putText(self.__window_data, self.qr_result, (10, 50), cv2.FONT_HERSHEY_SIMPLEX, 1.0, (0, 0, 255), 2, cv2.LINE_AA)
             # cv2.putText(self.__window_data, f"Avg Latency: {avg_latency:.1f} ms", (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 1.0, (0, 255, 0), 2, cv2.LINE_AA)
 
-    # show_windowの引数を変更し、生のカメラデータとレイテンシを直接受け取る
-    def show_window(self, camera_data_bytes, avg_latency):
-        if camera_data_bytes is not None:
-            self.__window_data = cv2.imdecode(np.frombuffer(camera_data_bytes, np.uint8), cv2.IMREAD_COLOR)
-            
-            if self.__window_data is None: # デコード失敗
-                # デコードに失敗した場合も黒い画面を表示
-                self.__window_data = np.zeros((480, 640, 3), dtype=np.uint8)
-                print("[WARN] Received data could not be decoded to an image.")
-
-            # リサイズはここで行うか、クライアント側で固定サイズに設定済みなら不要
-            # if self.__window_data.shape[1] != 640 or self.__window_data.shape[0] != 480:
-            #     self.__window_data = cv2.resize(self.__window_data, (640, 480)) # 不要であればコメントアウト
-
-            self.read_qr() # QRコード検出 (self.__window_dataにテキストや図形が追加される)
+    # show_windowの引数を変更し、デコード済みのフレームとレイテンシを直接受け取る
+    # (JPEGのデコードはクライアントごとのデコードプロセスで行う)
+    def show_window(self, frame, avg_latency, frame_seq=None):
+        if frame is not None:
+            if frame_seq is not None and frame_seq == self.__last_frame_seq and not self.qr_request:
+                # 新しいフレームが届いていなければ描画せず、前回の画像をそのまま表示する
+                cv2.imshow("Camera Feed", self.__window_data)
+                return
+            self.__last_frame_seq = frame_seq
+
+            # フレームはデコード時に FRAME_SHAPE (640x480) であることを確認済みなのでリサイズは不要
+            # frame は read_frame がコピーした表示用バッファなので、追加のコピーをせずそのまま描画する
+            self.__window_data = frame
+
+            self.read_qr(frame) # QRコード検出 (self.__window_dataにテキストや図形が追加される)
             self.draw_text(avg_latency) # テキスト描画 (self.__window_dataにテキストが追加される)
             
-        else: # camera_data_bytes が None の場合（まだデータが来ていない、またはエラー）
-            self.__window_data = np.zeros((480, 640, 3), dtype=np.uint8) # 黒い画面を表示
+        else: # frame が None の場合（まだデータが来ていない、またはエラー）
+            self.__last_frame_seq = None
+            self.__window_data = np.zeros(FRAME_SHAPE, dtype=np.uint8) # 黒い画面を表示
             self.draw_text(avg_latency) # レイテンシだけ表示
 
         cv2.imshow("Camera Feed", self.__window_data)
@@ -330,5 +596,7 @@ class Display: # クラス名を'display'から'Display'に変更 (PEP8準拠)
             print("[INFO] QRコード検出をリクエストしました。")
 
 if __name__ == '__main__':
-    server = CameraServer()
+    # GPU (nvJPEG) でのデコードは '--gpu-decode' を付けて起動した場合のみ使う (例: python main_show_ver_2.py --gpu-decode)
+    use_gpu_decode = '--gpu-decode' in sys.argv[1:]
+    server = CameraServer(use_gpu_decode=use_gpu_decode)
     server.run()
\ No newline at end of file